@@ -0,0 +1,351 @@
+# audit.py  • report archive integrity audit
+# Standalone on purpose: importing main.py needs a display (tk variables are built at import time),
+# so this module only depends on aiosqlite + cryptography and is safe to re-import in pool workers.
+from __future__ import annotations
+import argparse, asyncio, hashlib, hmac, json, logging, multiprocessing, os, sys, time
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from base64 import b64decode
+
+import aiosqlite
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+MASTER_KEY    = os.path.expanduser("~/.cache/ci_qmhs_master_key.bin")
+SETTINGS_FILE = "settings.enc.json"
+DEFAULT_DB    = "ci_harmred_reports.db"
+CHAIN_GENESIS = "0" * 64
+ROW_FINDINGS  = ("tampered", "undecryptable", "no_digest", "mismatch")
+FINDINGS      = (*ROW_FINDINGS, "duplicate")
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
+LOGGER = logging.getLogger("qmhs.audit")
+
+# === Keys & Settings ===
+def load_key(path: str = MASTER_KEY) -> bytes:
+    with open(os.path.expanduser(path), "rb") as f:
+        return f.read()
+
+def _decrypt(aes: AESGCM, blob: bytes | str) -> bytes:
+    raw = b64decode(blob)
+    return aes.decrypt(raw[:12], raw[12:], None)
+
+def settings_db_path(key: bytes, path: str = SETTINGS_FILE) -> str:
+    if not os.path.exists(path):
+        return DEFAULT_DB
+    try:
+        with open(path, "rb") as f:
+            return json.loads(_decrypt(AESGCM(key), f.read()).decode()).get("db_path", DEFAULT_DB)
+    except Exception as e:
+        LOGGER.error("Settings error, using default DB path: %s", e)
+        return DEFAULT_DB
+
+# === Archive Access ===
+_MISSING = object()
+
+async def open_archive(db_path: str) -> aiosqlite.Connection:
+    # mode=rw: a mistyped path must fail instead of leaving an empty database behind.
+    if not os.path.isfile(db_path):
+        raise FileNotFoundError(f"Report database not found: {db_path}")
+    conn = await aiosqlite.connect(Path(db_path).resolve().as_uri() + "?mode=rw", uri=True)
+    cur = await conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'scans'")
+    if not await cur.fetchone():
+        await conn.close()
+        raise ValueError(f"{db_path} has no scans table")
+    cur = await conn.execute("PRAGMA table_info(audit_checkpoints)")
+    cols = [r[1] for r in await cur.fetchall()]
+    if cols and "seq" not in cols:
+        # Pre-MAC checkpoints cannot be verified; keep them for inspection and start a fresh chain.
+        LOGGER.warning("Unkeyed audit checkpoints moved to audit_checkpoints_legacy.")
+        await conn.execute("ALTER TABLE audit_checkpoints RENAME TO audit_checkpoints_legacy")
+    await conn.execute(
+        "CREATE TABLE IF NOT EXISTS audit_checkpoints(seq INTEGER PRIMARY KEY, ts REAL, last_row INTEGER, "
+        "head TEXT, leaf TEXT, bad TEXT, acked TEXT, base INTEGER, prev TEXT, mac TEXT)"
+    )
+    await conn.execute("CREATE TABLE IF NOT EXISTS audit_leaves(leaf TEXT PRIMARY KEY, row_id INTEGER)")
+    await conn.commit()
+    return conn
+
+async def load_checkpoints(conn: aiosqlite.Connection) -> List[Dict[str, Any]]:
+    cur = await conn.execute(
+        "SELECT seq, ts, last_row, head, leaf, bad, acked, base, prev, mac FROM audit_checkpoints ORDER BY seq"
+    )
+    return [
+        {"seq": s, "ts": ts, "last_row": r, "head": h, "leaf": l, "bad": json.loads(b or "[]"),
+         "acked": json.loads(a or "[]"), "base": int(base or 0), "prev": p or "", "mac": m or ""}
+        for s, ts, r, h, l, b, a, base, p, m in await cur.fetchall()
+    ]
+
+async def add_checkpoint(conn: aiosqlite.Connection, cp: Dict[str, Any]) -> None:
+    await conn.execute(
+        "INSERT INTO audit_checkpoints(seq, ts, last_row, head, leaf, bad, acked, base, prev, mac) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (cp["seq"], cp["ts"], cp["last_row"], cp["head"], cp["leaf"], json.dumps(cp["bad"]),
+         json.dumps(cp["acked"]), cp["base"], cp["prev"], cp["mac"]),
+    )
+    await conn.commit()
+
+async def known_leaves(conn: aiosqlite.Connection, leaves: List[str]) -> Dict[str, int]:
+    found: Dict[str, int] = {}
+    for i in range(0, len(leaves), 500):
+        part = leaves[i:i + 500]
+        cur = await conn.execute(
+            f"SELECT leaf, row_id FROM audit_leaves WHERE leaf IN ({','.join('?' * len(part))})", part
+        )
+        found.update(dict(await cur.fetchall()))
+    return found
+
+async def store_leaves(conn: aiosqlite.Connection, leaves: Dict[str, int], replace: bool) -> None:
+    if replace:
+        await conn.execute("DELETE FROM audit_leaves")
+    await conn.executemany("INSERT OR IGNORE INTO audit_leaves(leaf, row_id) VALUES (?, ?)", leaves.items())
+    await conn.commit()
+
+async def read_blob(conn: aiosqlite.Connection, row_id: int) -> Any:
+    cur = await conn.execute("SELECT blob FROM scans WHERE id = ?", (row_id,))
+    res = await cur.fetchone()
+    return res[0] if res else _MISSING
+
+async def iter_blobs(conn: aiosqlite.Connection, after_id: int = 0, batch: int = 256) -> AsyncIterator[List[Tuple[int, Any]]]:
+    # Raw column values: NULL/TEXT blobs are findings for the workers, not reasons to crash here.
+    cur = await conn.execute("SELECT id, blob FROM scans WHERE id > ? ORDER BY id", (after_id,))
+    while rows := await cur.fetchmany(batch):
+        yield [(rid, bytes(blob) if isinstance(blob, memoryview) else blob) for rid, blob in rows]
+    await cur.close()
+
+# === Hashing ===
+def _blob_bytes(blob: Any) -> Optional[bytes]:
+    if blob is None:
+        return None
+    if isinstance(blob, (bytes, bytearray, memoryview)):
+        return bytes(blob)
+    return str(blob).encode()
+
+def leaf_hash(blob: Any) -> str:
+    # Type-tagged so a NULL, a TEXT and a BLOB with the same bytes never share a leaf.
+    tag = b"N" if blob is None else b"B" if isinstance(blob, (bytes, bytearray, memoryview)) else b"T"
+    return hashlib.sha256(tag + (_blob_bytes(blob) or b"")).hexdigest()
+
+def chain_link(key: bytes, head: str, row_id: int, leaf: str) -> str:
+    msg = bytes.fromhex(head) + row_id.to_bytes(8, "big") + bytes.fromhex(leaf)
+    return hmac.new(key, msg, hashlib.sha256).hexdigest()
+
+def checkpoint_mac(key: bytes, cp: Dict[str, Any]) -> str:
+    msg = json.dumps([cp["seq"], cp["ts"], cp["last_row"], cp["head"], cp["leaf"],
+                      cp["bad"], cp["acked"], cp["base"], cp["prev"]])
+    return hmac.new(key, msg.encode(), hashlib.sha256).hexdigest()
+
+def verify_checkpoints(key: bytes, marks: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[int]]:
+    # Checkpoints form a MAC'd list: each links to the previous one's MAC and seq. A valid baseline
+    # restarts trust; after any forged, edited or missing entry nothing later is trusted.
+    trusted: List[Dict[str, Any]] = []
+    breaks: List[int] = []
+    prev, broken = None, False
+    for cp in marks:
+        ok = hmac.compare_digest(cp["mac"], checkpoint_mac(key, cp))
+        if prev is None:
+            linked = cp["seq"] == 1 and cp["prev"] == ""
+        else:
+            linked = cp["seq"] == prev["seq"] + 1 and cp["prev"] == prev["mac"]
+        if ok and cp["base"]:
+            trusted, breaks, broken = [cp], [], False
+        elif ok and linked and not broken:
+            trusted.append(cp)
+        else:
+            broken = True
+            if not (ok and linked):
+                breaks.append(cp["seq"])
+        prev = cp
+    return trusted, breaks
+
+# === Workers ===
+_AUDIT_AES: Optional[AESGCM] = None
+
+def _audit_init(key: bytes) -> None:
+    global _AUDIT_AES
+    _AUDIT_AES = AESGCM(key)
+
+def _audit_rows(rows: List[Tuple[int, Any]]) -> List[Tuple[int, str, str]]:
+    # Runs in a pool worker: returns (row_id, status, leaf hash of the stored value) per row.
+    out = []
+    for rid, blob in rows:
+        leaf = leaf_hash(blob)
+        data = _blob_bytes(blob)
+        if data is None:
+            out.append((rid, "undecryptable", leaf))
+            continue
+        try:
+            plain = _decrypt(_AUDIT_AES, data)
+        except InvalidTag:
+            out.append((rid, "tampered", leaf))
+            continue
+        except Exception:
+            out.append((rid, "undecryptable", leaf))
+            continue
+        try:
+            rpt = json.loads(plain.decode())
+        except Exception:
+            out.append((rid, "undecryptable", leaf))
+            continue
+        hdr = rpt.get("s4") if isinstance(rpt, dict) else None
+        if not isinstance(hdr, dict) or "digest" not in hdr:
+            out.append((rid, "no_digest", leaf))
+            continue
+        hdr = dict(hdr)
+        digest = hdr.pop("digest")
+        ok = hashlib.sha256(json.dumps(hdr).encode()).hexdigest() == digest
+        out.append((rid, "ok" if ok else "mismatch", leaf))
+    return out
+
+# === Audit ===
+async def audit_reports(db_path: str, key: bytes, full: bool = False, checkpoint: bool = True,
+                        workers: Optional[int] = None, batch: int = 256, rebaseline: bool = False,
+                        pin: Optional[Tuple[int, str]] = None) -> Dict[str, Any]:
+    full = full or rebaseline
+    workers = workers or os.cpu_count() or 2
+    conn: Optional[aiosqlite.Connection] = None
+    pool: Optional[ProcessPoolExecutor] = None
+    try:
+        conn = await open_archive(db_path)
+        # spawn: never fork while the aiosqlite thread is alive.
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_audit_init, initargs=(key,))
+        marks = await load_checkpoints(conn)
+        trusted, cp_breaks = verify_checkpoints(key, marks)
+        result: Dict[str, Any] = {"from_row": 0, "checked": 0, "ok": 0, "chain_breaks": [],
+                                  "checkpoint_breaks": cp_breaks, "known_bad": [], "checkpoint": None,
+                                  **{k: [] for k in FINDINGS}}
+        if pin and not any(cp["seq"] == pin[0] and cp["head"] == pin[1]
+                           and hmac.compare_digest(cp["mac"], checkpoint_mac(key, cp)) for cp in marks):
+            # The pinned checkpoint was recorded outside the DB; losing it means the table was rewritten.
+            result["checkpoint_breaks"].append(pin[0])
+
+        anchor = trusted[-1] if trusted else None
+        start, head = 0, CHAIN_GENESIS
+        by_row: Dict[int, List[Dict[str, Any]]] = {}
+        if full:
+            for cp in trusted:
+                by_row.setdefault(cp["last_row"], []).append(cp)
+        elif anchor:
+            start, head = anchor["last_row"], anchor["head"]
+            result["known_bad"] = list(anchor["bad"])
+            # The checkpointed row must still be the one we hashed, or a deleted top row's id was reused.
+            blob = await read_blob(conn, start)
+            if blob is _MISSING or leaf_hash(blob) != anchor["leaf"]:
+                result["chain_breaks"].append(start)
+        result["from_row"] = start
+
+        loop = asyncio.get_running_loop()
+        pending: deque = deque()
+        seen: set = set()
+        leaves: Dict[str, int] = {}
+        last_row, last_leaf = start, anchor["leaf"] if anchor and not full else ""
+
+        async def consume(rows: List[Tuple[int, str, str]]) -> None:
+            nonlocal head, last_row, last_leaf
+            prior = {} if full else await known_leaves(conn, [l for _, s, l in rows if s == "ok"])
+            for rid, status, leaf in rows:
+                head = chain_link(key, head, rid, leaf)
+                last_row, last_leaf = rid, leaf
+                seen.add(rid)
+                result["checked"] += 1
+                if status != "ok":
+                    result[status].append(rid)
+                elif leaf in leaves or leaf in prior:
+                    # Same ciphertext stored under a second id: a replayed report.
+                    result["duplicate"].append(rid)
+                else:
+                    leaves[leaf] = rid
+                    result["ok"] += 1
+                if any(cp["head"] != head or cp["leaf"] != leaf for cp in by_row.get(rid, ())):
+                    result["chain_breaks"].append(rid)
+
+        async for rows in iter_blobs(conn, start, batch):
+            pending.append(loop.run_in_executor(pool, _audit_rows, rows))
+            if len(pending) >= workers * 2:
+                await consume(await pending.popleft())
+        while pending:
+            await consume(await pending.popleft())
+
+        # A checkpointed row that no longer exists means the archive was truncated or rows were deleted.
+        result["chain_breaks"] += sorted(r for r in by_row if r > start and r not in seen)
+        found = {rid for k in (*FINDINGS, "chain_breaks") for rid in result[k]}
+        all_bad = found | set(result["known_bad"])
+        if rebaseline:
+            acked, bad = sorted(all_bad), []
+        else:
+            acked = list(anchor["acked"]) if anchor else []
+            bad = sorted(all_bad - set(acked))
+        result["known_bad"] = sorted(set(result["known_bad"]) - found)
+        result.update(head=head, last_row=last_row, acked=acked, unacked=bad)
+
+        # Every --full run persists what it found, so incremental runs never resume from a head it
+        # showed to be stale; an untrusted checkpoint tail is only cleared by --rebaseline.
+        changed = full or last_row > start or (anchor is not None and bad != anchor["bad"])
+        if checkpoint and last_row > 0 and changed and (rebaseline or not cp_breaks):
+            cp = {"seq": marks[-1]["seq"] + 1 if marks else 1, "ts": time.time(), "last_row": last_row,
+                  "head": head, "leaf": last_leaf, "bad": bad, "acked": acked, "base": int(rebaseline),
+                  "prev": marks[-1]["mac"] if marks else ""}
+            cp["mac"] = checkpoint_mac(key, cp)
+            await add_checkpoint(conn, cp)
+            await store_leaves(conn, leaves, replace=full)
+            result["checkpoint"] = cp
+        return result
+    finally:
+        if conn is not None:
+            await conn.close()
+        if pool is not None:
+            pool.shutdown()
+
+def _parse_pin(value: str) -> Tuple[int, str]:
+    seq, _, head = value.partition(":")
+    if not seq.isdigit() or len(head) != 64:
+        raise argparse.ArgumentTypeError("expected SEQ:HEAD as printed by a previous audit")
+    return int(seq), head
+
+def audit_cli(argv: List[str]) -> int:
+    ap = argparse.ArgumentParser(prog="audit.py", description="Verify s4 digests of stored reports.")
+    ap.add_argument("--full", action="store_true", help="re-verify every row, ignoring the last checkpoint")
+    ap.add_argument("--rebaseline", action="store_true",
+                    help="full audit that acknowledges current findings and restarts the checkpoint chain")
+    ap.add_argument("--no-checkpoint", action="store_true", help="do not record a new chain checkpoint")
+    ap.add_argument("--pin", type=_parse_pin, default=None, metavar="SEQ:HEAD",
+                    help="checkpoint recorded outside the database that must still be present")
+    ap.add_argument("--db", default=None, help="report database (default: db_path from settings)")
+    ap.add_argument("--key", default=MASTER_KEY, help="master key file")
+    ap.add_argument("--workers", type=int, default=None)
+    ap.add_argument("--batch", type=int, default=256)
+    args = ap.parse_args(argv)
+    try:
+        key = load_key(args.key)
+        db_path = args.db or settings_db_path(key)
+        res = asyncio.run(audit_reports(db_path, key, args.full, not args.no_checkpoint, args.workers,
+                                        args.batch, args.rebaseline, args.pin))
+    except (OSError, ValueError) as e:
+        LOGGER.error("Audit failed: %s", e)
+        return 2
+
+    if res["checked"]:
+        LOGGER.info("Audit rows %d..%d: %d checked, %d ok",
+                    res["from_row"] + 1, res["last_row"], res["checked"], res["ok"])
+    else:
+        LOGGER.info("No new rows since checkpoint at row %d.", res["from_row"])
+    for k in (*FINDINGS, "chain_breaks", "checkpoint_breaks"):
+        if res[k]:
+            LOGGER.error("%s: %s", k, ", ".join(map(str, res[k])))
+    if res["known_bad"]:
+        LOGGER.warning("previously flagged: %s", ", ".join(map(str, res["known_bad"])))
+    if res["acked"]:
+        LOGGER.info("acknowledged: %s", ", ".join(map(str, res["acked"])))
+    cp = res["checkpoint"]
+    if cp:
+        # Record this line somewhere the DB's writers cannot reach and pass it back via --pin.
+        LOGGER.info("Checkpoint %d at row %d, pin %d:%s", cp["seq"], cp["last_row"], cp["seq"], cp["head"])
+    else:
+        LOGGER.info("Chain head at row %d: %s", res["last_row"], res["head"])
+    return 1 if res["unacked"] or res["checkpoint_breaks"] else 0
+
+if __name__ == "__main__":
+    sys.exit(audit_cli(sys.argv[1:]))
@@ -0,0 +1,139 @@
+import asyncio, hashlib, json, os, secrets, sqlite3
+from base64 import b64decode, b64encode
+
+import pytest
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+import audit
+
+KEY = bytes(range(16))
+
+def _encrypt(data: bytes) -> bytes:
+    nonce = secrets.token_bytes(12)
+    return b64encode(nonce + AESGCM(KEY).encrypt(nonce, data, None))
+
+def _report(i: int, digest: bool = True) -> bytes:
+    hdr = {"ts": 1000.0 + i, "theta": 0.5, "risk": "Safe & <ok>", "actions": ["Observe breathing"],
+           "cooldown": 10, "toxicityScore": 2, "naloxone_stock": 10, "confidence": 0.75}
+    if digest:
+        hdr["digest"] = hashlib.sha256(json.dumps(hdr).encode()).hexdigest()
+    return _encrypt(json.dumps({"s0": {}, "s4": hdr}).encode())
+
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / "reports.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE scans(id INTEGER PRIMARY KEY, ts REAL, blob BLOB)")
+    conn.commit()
+    conn.close()
+    return path
+
+def _exec(path, sql, *params):
+    conn = sqlite3.connect(path)
+    conn.execute(sql, params)
+    conn.commit()
+    conn.close()
+
+def _add(path, n, start=0):
+    for i in range(n):
+        _exec(path, "INSERT INTO scans(ts, blob) VALUES (?, ?)", 1.0, _report(start + i))
+
+def _run(path, **kw):
+    return asyncio.run(audit.audit_reports(path, KEY, workers=2, batch=4, **kw))
+
+def test_clean_run_then_incremental(db):
+    _add(db, 10)
+    res = _run(db)
+    assert (res["checked"], res["ok"], res["unacked"]) == (10, 10, [])
+    assert res["checkpoint"]["last_row"] == 10
+    _add(db, 3, 10)
+    res = _run(db)
+    assert (res["from_row"], res["checked"], res["ok"]) == (10, 3, 3)
+    res = _run(db)
+    assert res["checked"] == 0 and res["checkpoint"] is None and res["unacked"] == []
+
+def test_row_findings(db):
+    _add(db, 3)
+    raw = bytearray(b64decode(_report(3)))
+    raw[-1] ^= 1
+    _exec(db, "INSERT INTO scans(ts, blob) VALUES (?, ?)", 1.0, b64encode(bytes(raw)))
+    forged = json.loads(audit._decrypt(AESGCM(KEY), _report(4)))
+    forged["s4"]["risk"] = "Overdose"
+    _exec(db, "INSERT INTO scans(ts, blob) VALUES (?, ?)", 1.0, _encrypt(json.dumps(forged).encode()))
+    _exec(db, "INSERT INTO scans(ts, blob) VALUES (?, ?)", 1.0, _encrypt(b'{"s0": {}}'))
+    _exec(db, "INSERT INTO scans(ts, blob) VALUES (?, ?)", 1.0, None)
+    _exec(db, "INSERT INTO scans(ts, blob) VALUES (?, ?)", 1.0, "x")
+    res = _run(db)
+    assert res["tampered"] == [4]
+    assert res["mismatch"] == [5]
+    assert res["no_digest"] == [6]
+    assert res["undecryptable"] == [7, 8]
+    assert res["unacked"] == [4, 5, 6, 7, 8]
+
+def test_replayed_blob_is_duplicate(db):
+    _add(db, 3)
+    _run(db)
+    blob = sqlite3.connect(db).execute("SELECT blob FROM scans WHERE id = 2").fetchone()[0]
+    _exec(db, "INSERT INTO scans(ts, blob) VALUES (?, ?)", 1.0, blob)
+    assert _run(db)["duplicate"] == [4]
+    assert _run(db, full=True)["duplicate"] == [4]
+
+def test_reused_top_row_id_is_chain_break(db):
+    _add(db, 5)
+    _run(db)
+    _exec(db, "DELETE FROM scans WHERE id = 5")
+    _add(db, 1, 99)
+    res = _run(db)
+    assert res["checked"] == 0 and res["chain_breaks"] == [5]
+    assert _run(db)["unacked"] == [5]
+
+def test_null_checkpoint_row_is_chain_break(db):
+    _add(db, 5)
+    _run(db)
+    _exec(db, "UPDATE scans SET blob = NULL WHERE id = 5")
+    assert _run(db)["chain_breaks"] == [5]
+
+def test_deleted_middle_row_under_full(db):
+    _add(db, 5)
+    _run(db)
+    _add(db, 5, 5)
+    _run(db)
+    _exec(db, "DELETE FROM scans WHERE id = 3")
+    assert _run(db)["unacked"] == []
+    res = _run(db, full=True)
+    assert res["chain_breaks"] == [5, 10]
+    assert res["unacked"] == [5, 10]
+
+def test_full_findings_persist_until_rebaseline(db):
+    _add(db, 8)
+    _run(db)
+    raw = bytearray(b64decode(sqlite3.connect(db).execute("SELECT blob FROM scans WHERE id = 3").fetchone()[0]))
+    raw[-1] ^= 1
+    _exec(db, "UPDATE scans SET blob = ? WHERE id = 3", b64encode(bytes(raw)))
+    res = _run(db, full=True)
+    assert res["tampered"] == [3] and res["chain_breaks"] == [8]
+    res = _run(db)
+    assert res["checked"] == 0 and res["known_bad"] == [3, 8] and res["unacked"] == [3, 8]
+    _add(db, 2, 8)
+    assert _run(db)["unacked"] == [3, 8]
+    res = _run(db, rebaseline=True)
+    assert res["acked"] == [3, 8] and res["unacked"] == []
+    assert _run(db)["unacked"] == []
+    assert _run(db, full=True)["chain_breaks"] == []
+
+def test_checkpoint_table_tampering(db):
+    _add(db, 4)
+    first = _run(db)["checkpoint"]
+    _add(db, 2, 4)
+    _run(db)
+    _exec(db, "UPDATE audit_checkpoints SET bad = '[1]' WHERE seq = 1")
+    assert _run(db)["checkpoint_breaks"] == [1]
+    _exec(db, "DELETE FROM audit_checkpoints")
+    res = _run(db, pin=(first["seq"], first["head"]))
+    assert res["checkpoint_breaks"] == [first["seq"]]
+
+def test_missing_database_is_not_created(tmp_path):
+    path = str(tmp_path / "nope.db")
+    with pytest.raises(FileNotFoundError):
+        _run(path)
+    assert not os.path.exists(path)